@@ -7,133 +7,472 @@
 
 
 import getpass  # For input prompt not to show what is entered
-import json     # Provide convinent functions to handle json objects 
-import requests # To handle http requests
+import json     # Provide convenient functions to handle JSON objects 
+import requests # To handle HTTP requests
 import os       # Operating System library to create directories and files
+import concurrent.futures # To download several files at the same time
+import shutil   # To copy the downloaded files to disk
+import sqlite3  # To keep the ETag of every downloaded file in a single database
+import threading # To share the ETag database between the download threads
+import logging  # To report the progress from several threads
+import logging.handlers # To write the messages of the threads from a single listener
+import queue    # To pass the messages of the threads to the listener
+import base64   # To read the expiration time of the login token
+import time     # To compare the token expiration with the current time
+import tempfile # To write the login token before putting it in place
+import urllib.parse # To use the username in the name of the token file
+import sys      # To return the exit code of the script
+from requests.adapters import HTTPAdapter # To configure the connection pool
+from urllib3.util.retry import Retry      # To retry failed requests
+import urllib3.exceptions # To catch the errors while a download is streamed
+
+# The password can be read from the system keyring when it is installed
+try:
+    import keyring
+except ImportError:
+    keyring = None
+
+# Use the faster orjson parser and serializer when it is installed.
+# json_dumps returns bytes in both cases
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    
+    def json_dumps(data):
+        return json.dumps(data).encode('utf-8')
+
+# The progress is reported through this logger, its handlers are set by main()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
 
 hostname = 'openpreventad.loris.ca'
 baseurl = 'https://' + hostname + '/api/v0.0.3-dev'
 
+# Number of files downloaded at the same time and of candidates processed
+# at the same time. Downloads wait on the network, not the CPU, so threads
+# are used and there are more of them than CPU cores. The number of
+# downloads can be set with the LORIS_CONCURRENCY environment variable
+def get_download_workers():
+    default = min(32, 4 * (os.cpu_count() or 1))
+    value = os.environ.get('LORIS_CONCURRENCY')
+    if value is None:
+        return default
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        logger.warning('LORIS_CONCURRENCY must be a positive number, using %d instead of %r', default, value)
+        return default
+    return workers
+
+
+download_workers = get_download_workers()
+candidate_workers = 4
+
+# A single session is shared by every request so the TCP/TLS connection to
+# the server is kept alive instead of being renegotiated for each call.
+# Failed requests are retried a limited number of times with an exponential backoff
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(
+    pool_connections = 8,
+    pool_maxsize = download_workers + candidate_workers,
+    max_retries = Retry(
+        total = 10,
+        connect = 10,
+        read = 10,
+        backoff_factor = 0.5,
+        status_forcelist = [500, 502, 503, 504],
+        allowed_methods = frozenset(['HEAD', 'GET', 'POST'])
+    )
+))
+
+# Connect and read timeouts in seconds so a stalled connection is retried
+request_timeout = (5, 30)
+
+# Files are downloaded a few at a time through the shared session
+download_executor = concurrent.futures.ThreadPoolExecutor(max_workers = download_workers)
+
+# Set when the download is interrupted, the candidates and files that did not
+# start yet are then skipped so only the running downloads have to finish
+stop_event = threading.Event()
+
+# The ETag of every downloaded file is kept in a single database so an
+# existing file can be revalidated with a conditional GET. It is opened by main()
+etag_database = None
+etag_lock = threading.Lock()
+
+
+def open_etag_database(path):
+    database = sqlite3.connect(path, check_same_thread = False)
+    database.execute('PRAGMA journal_mode=WAL')
+    database.execute('PRAGMA synchronous=NORMAL')
+    database.execute('CREATE TABLE IF NOT EXISTS etags (path TEXT PRIMARY KEY, etag TEXT)')
+    return database
+
+
+def get_etag(path):
+    with etag_lock:
+        row = etag_database.execute('SELECT etag FROM etags WHERE path = ?', (path,)).fetchone()
+    return row[0] if row else None
+
+
+def set_etag(path, etag):
+    # The ETags are committed in batches by commit_etags()
+    with etag_lock:
+        etag_database.execute('INSERT OR REPLACE INTO etags (path, etag) VALUES (?, ?)', (path, etag))
+
+
+def commit_etags():
+    with etag_lock:
+        etag_database.commit()
+
+
+def get_json(api_request, cachepath = None):
+    # When a cache path is given, the reply is kept on disk with its ETag and
+    # is only downloaded again if it changed on the server
+    headers = {}
+    if cachepath is not None and os.path.isfile(cachepath):
+        etag = get_etag(cachepath)
+        if etag is not None:
+            headers['If-None-Match'] = etag
+    
+    # The parsers accept the raw bytes of the response, no need to decode them first
+    response = http_session.get(
+        url = baseurl + api_request,
+        headers = headers,
+        timeout = request_timeout
+    )
+    if cachepath is not None and response.status_code == 304:
+        with open(cachepath, "rb") as cachefile:
+            return json_loads(cachefile.read())
+    response.raise_for_status()
+    
+    if cachepath is not None and 'ETag' in response.headers:
+        with open(cachepath, "wb") as cachefile:
+            cachefile.write(response.content)
+        set_etag(cachepath, response.headers['ETag'])
+        commit_etags()
+    return json_loads(response.content)
+
+
+def download_file(url, path, exists = None):
+    if stop_event.is_set():
+        return
+    
+    # The caller can tell whether the file exists to avoid a stat per file
+    if exists is None:
+        exists = os.path.isfile(path)
+    
+    headers = {}
+    if exists:
+        etag = get_etag(path)
+        if etag is None:
+            # Files downloaded without an ETag are kept if they have the size
+            # announced by the server, or if the server doesn't announce it.
+            # Otherwise they are downloaded again. The size is asked without
+            # compression since the files are written decompressed
+            response = http_session.head(url = url, headers = {'Accept-Encoding': 'identity'}, timeout = request_timeout)
+            if not response.ok or 'Content-Length' not in response.headers or int(response.headers['Content-Length']) == os.path.getsize(path):
+                if 'ETag' in response.headers:
+                    set_etag(path, response.headers['ETag'])
+                return
+        else:
+            headers['If-None-Match'] = etag
+    
+    # Stream the file to disk by chunks instead of holding it in memory.
+    # It is written under a temporary name so an interrupted download
+    # is not mistaken for a complete file on the next run
+    with http_session.get(url = url, headers = headers, stream = True, timeout = request_timeout) as response:
+        # The file on disk is still up to date
+        if response.status_code == 304:
+            return
+        response.raise_for_status()
+        response.raw.decode_content = True
+        try:
+            with open(path + '.part', "w+b") as outputfile:
+                shutil.copyfileobj(response.raw, outputfile, 1 << 20)
+        except BaseException as error:
+            # Don't leave the partial file behind. The raw stream raises
+            # urllib3's errors, they are reported like the other request errors
+            if os.path.exists(path + '.part'):
+                os.remove(path + '.part')
+            if isinstance(error, urllib3.exceptions.HTTPError):
+                raise requests.ConnectionError(error, request = response.request) from error
+            raise
+        os.replace(path + '.part', path)
+        
+        if 'ETag' in response.headers:
+            set_etag(path, response.headers['ETag'])
+
 
 # ### Login procedure  
-# This will ask for your username and password and print the login result
+# This will ask for your username and password and print the login result. They can also be given with the `LORIS_USERNAME` and `LORIS_PASSWORD` environment variables, and the password can be saved in the system keyring under the `loris` service. The login of each user is saved in `~/.cache/preventad` and reused until it expires or is refused by the server
 
 # In[ ]:
 
 
-print('Login on ' + hostname)
+# The token of each user is saved between runs and reused until it expires.
+# The username is escaped so it can't point outside of the directory
+def token_path(username):
+    return os.path.join(os.path.expanduser('~'), '.cache', 'preventad', hostname, urllib.parse.quote(username, safe = '') + '.token')
+
 
-# Prepare the credentials using promp
-payload = {
-    'username': input('username: '), 
-    'password': getpass.getpass('password: ')
-}
+def save_token(tokenpath, token):
+    # The token is written to a temporary file only readable by the user,
+    # which then replaces the saved token with its permissions
+    os.makedirs(os.path.dirname(tokenpath), exist_ok = True)
+    descriptor, temporarypath = tempfile.mkstemp(dir = os.path.dirname(tokenpath))
+    try:
+        with open(descriptor, "w") as tokenfile:
+            tokenfile.write(token)
+        os.replace(temporarypath, tokenpath)
+    except BaseException:
+        os.remove(temporarypath)
+        raise
 
-# Send a HTTP POST request to the /login endpoint
-response = requests.post(
-    url = baseurl + '/login',
-    json = payload,
-    verify = True
-)
 
-text = response.content.decode('ascii')
+def token_expiration(token):
+    # The expiration time is in the payload, the second part of the JWT.
+    # A token that can't be read is considered expired
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = json_loads(base64.urlsafe_b64decode(payload))
+    except (IndexError, ValueError):
+        return 0
+    if not isinstance(claims, dict) or not isinstance(claims.get('exp'), (int, float)):
+        return 0
+    return claims['exp']
 
-# If the response is successful (HHTP 200), extract the JWT token 
-if (response.status_code == 200):
-    token = json.loads(text)['token']
-    print('login successfull')
-else:
-    print(text)
+
+def get_username():
+    return os.environ.get('LORIS_USERNAME') or input('username: ')
+
+
+def login(username, usesaved = True):
+    # Return the JWT token, or None if the login failed
+    tokenpath = token_path(username)
+    token = None
+    if usesaved and os.path.isfile(tokenpath):
+        with open(tokenpath) as tokenfile:
+            savedtoken = tokenfile.read().strip()
+        if token_expiration(savedtoken) > time.time() + 60:
+            token = savedtoken
+
+    if token is not None:
+        logger.info('Using the saved login of %s on %s', username, hostname)
+    else:
+        logger.info('Login on %s', hostname)
+        
+        # Prepare the credentials using prompt. The password is taken from the
+        # LORIS_PASSWORD environment variable or the keyring when available
+        password = os.environ.get('LORIS_PASSWORD')
+        if not password and keyring is not None:
+            password = keyring.get_password('loris', username)
+        if not password:
+            password = getpass.getpass('password: ')
+        payload = {
+            'username': username, 
+            'password': password
+        }
+        
+        # Send an HTTP POST request to the /login endpoint
+        response = http_session.post(
+            url = baseurl + '/login',
+            json = payload,
+            verify = True,
+            timeout = request_timeout
+        )
+        
+        # If the response is successful (HTTP 200), extract the JWT token and save it
+        if (response.status_code == 200):
+            token = json_loads(response.content)['token']
+            save_token(tokenpath, token)
+            logger.info('login successfull')
+        else:
+            logger.error(response.text)
+
+    if token is not None:
+        http_session.headers['Authorization'] = 'Bearer %s' % token
+    return token
 
 
 # ### Extraction  
 # For each visits of each candidates this will create a directory `/<CandID>/<VisitLable>` and download all this files and their qc info into it.  
 # 
-# It wont download files that already exists. This validation is based on filename solely and not on it content... yet
+# It wont download files that already exists. When the server sent an ETag for a file, the file is revalidated with a conditional request and downloaded again only if it changed. The ETags are kept in `.etags.sqlite`. Files without an ETag are downloaded again only if their size differs from the one given by the server
 
 # In[ ]:
 
 
-# Get a list of all the candidates
-candidates = json.loads(requests.get(
-    url = baseurl + '/candidates/',
-    headers = {'Authorization': 'Bearer %s' % token}
-).content.decode('ascii'))
-
-candidatetotal = len(candidates['Candidates'])
-print(str(candidatetotal) + ' candidates found')
-print("-------------------------------------------\n")
-processedcandidates = 0
-
-for candidate in candidates['Candidates']:
-    candid = candidate['CandID']
+def process_candidate(candid):
+    # Return the number of visits and files that could not be downloaded, a
+    # failed request is reported and the other visits and files are still downloaded
+    failures = 0
+    if stop_event.is_set():
+        return failures
+    logger.info('Processing candidate #%s', candid)
     
-    print('Processing candidate #' + candid + "\n")
+    # Get that candidate's list of sessions
+    candidaterequest = '/candidates/' + candid
+    sessions = get_json(candidaterequest)
     
-    # Get that candidate's sessions
-    sessions = json.loads(requests.get(
-        url = baseurl + '/candidates/' + candid,
-        headers = {'Authorization': 'Bearer %s' % token}
-    ).content.decode('ascii'))
+    logger.info('%d sessions found for candidate #%s', len(sessions['Visits']), candid)
     
-    print(str(len(sessions['Visits'])) + " sessions found\n")
+    # Request the information and the list of images of every visit at once,
+    # these requests don't depend on each other
+    visitrequests = {}
+    sessionrequests = {}
+    filesrequests = {}
+    for visit in sessions['Visits']:
+        visitrequest = visitrequests[visit] = candidaterequest + '/' + visit
+        sessionrequests[visit] = download_executor.submit(get_json, visitrequest)
+        filesrequests[visit] = download_executor.submit(get_json, visitrequest + '/images')
     
     for visit in sessions['Visits']:
+        if stop_event.is_set():
+            break
+        
         # Create the directory for that visit if it doesn't already exists
-        directory = candid + '/' + visit
+        directory = os.path.join(candid, visit)
+        os.makedirs(directory, exist_ok = True)
+        
+        # List the files already downloaded in a single directory scan
+        existingfiles = {entry.name for entry in os.scandir(directory) if entry.is_file()}
+        
+        # Get the session information and the list of all the images for the session
+        visitrequest = visitrequests[visit]
         try:
-            os.makedirs(directory)
-        except FileExistsError:
-            pass
-        
-        # Get the session informations
-        session = json.loads(requests.get(
-            url = baseurl + '/candidates/' + candid + '/' + visit,
-            headers = {'Authorization': 'Bearer %s' % token}
-        ).content.decode('ascii'))
-        
-        # Write the session infos in a json file
-        sessionmetafile = open(directory + '/session.json', "w")
-        sessionmetafile.write(str(session['Meta']))
-        sessionmetafile.close()
-            
-        # Get a list of all the scans
-        files = json.loads(requests.get(
-            url = baseurl + '/candidates/' + candid + '/' + visit + '/images',
-            headers = {'Authorization': 'Bearer %s' % token}
-        ).content.decode('ascii'))
-        
-        print(str(len(files['Files'])) + ' files found for session ' + visit)
+            session = sessionrequests[visit].result()
+            files = filesrequests[visit].result()
+        except requests.RequestException as error:
+            logger.error('Could not get session %s/%s: %s', candid, visit, error)
+            failures += 1
+            continue
+        
+        # Write the session information into a JSON file
+        with open(os.path.join(directory, 'session.json'), "wb") as sessionmetafile:
+            sessionmetafile.write(json_dumps(session['Meta']))
+        
+        logger.info('%d files found for session %s/%s', len(files['Files']), candid, visit)
         
+        # Download the files and their qc at the same time
+        imagesurl = baseurl + visitrequest + '/images/'
+        downloads = {}
         for file in files['Files']:
             filename = file['Filename']
-            
-            # Download the file if it doesn't already exists
-            relativepath = directory + '/' + filename
-            if not os.path.isfile(relativepath):
-                image = requests.get(
-                    url = baseurl + '/candidates/' + candid + '/' + visit + '/images/' + filename,
-                    headers = {'Authorization': 'Bearer %s' % token}
-                )
-                mincfile = open(relativepath, "w+b")
-                mincfile.write(bytes(image.content))
-                
-            # Download the file qc if it doesn't already exists
-            relativepath = directory + '/' + filename + '.qc.json'
-            if not os.path.isfile(relativepath):
-                qc = requests.get(
-                    url = baseurl + '/candidates/' + candid + '/' + visit + '/images/' + filename + '/qc',
-                    headers = {'Authorization': 'Bearer %s' % token}
-                )
-                qcfile = open(relativepath, "w+b")
-                qcfile.write(bytes(qc.content))
-              
-    processedcandidates += 1
-    print("\n-------------------------------------------")
-    print(str(processedcandidates) + ' out of ' + str(candidatetotal) + ' candidates processed')
-    print("-------------------------------------------\n")
-            
+            fileurl = imagesurl + filename
+            filepath = os.path.join(directory, filename)
+            downloads[download_executor.submit(download_file, fileurl, filepath, filename in existingfiles)] = filepath
+            downloads[download_executor.submit(download_file, fileurl + '/qc', filepath + '.qc.json', filename + '.qc.json' in existingfiles)] = filepath + '.qc.json'
+        
+        # Report the files that could not be downloaded, the error gives the
+        # status and the url
+        for download in concurrent.futures.as_completed(downloads):
+            try:
+                download.result()
+            except requests.RequestException as error:
+                logger.error('Could not download %s: %s', downloads[download], error)
+                failures += 1
+        
+        # Save the ETags of the visit's files at once
+        commit_etags()
+    
+    return failures
+
+
+def main():
+    global etag_database
+    
+    stop_event.clear()
+    
+    # The threads only put their messages in a queue, a single listener thread
+    # writes them to the console so the downloads don't wait on each other to print
+    log_queue = queue.Queue()
+    log_handler = logging.handlers.QueueHandler(log_queue)
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    log_listener = logging.handlers.QueueListener(log_queue, console_handler)
+    logger.addHandler(log_handler)
+    log_listener.start()
+    try:
+        etag_database = open_etag_database('.etags.sqlite')
+        
+        username = get_username()
+        if login(username) is None:
+            return 1
+        
+        # Get the list of all the candidates, it is kept in candidates.json between runs.
+        # If the server refuses the saved login, it is dropped and the user logs in again
+        try:
+            candidates = get_json('/candidates/', 'candidates.json')
+        except requests.HTTPError as error:
+            if error.response is None or error.response.status_code != 401:
+                raise
+            logger.info('The saved login was refused by %s', hostname)
+            if os.path.isfile(token_path(username)):
+                os.remove(token_path(username))
+            if login(username, usesaved = False) is None:
+                return 1
+            candidates = get_json('/candidates/', 'candidates.json')
+        
+        candidatetotal = len(candidates['Candidates'])
+        logger.info('%d candidates found', candidatetotal)
+        logger.info("-------------------------------------------")
+        
+        # Several candidates are processed at the same time in this process, they all
+        # share the session's connection pool
+        processedcandidates = 0
+        failedcandidates = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers = candidate_workers) as candidate_executor:
+            # Report each candidate as soon as it is done instead of in the listing order.
+            # A candidate that fails is reported and the others keep going
+            processing = {candidate_executor.submit(process_candidate, candidate['CandID']): candidate['CandID'] for candidate in candidates['Candidates']}
+            try:
+                for processed in concurrent.futures.as_completed(processing):
+                    try:
+                        failures = processed.result()
+                    except Exception as error:
+                        logger.error('Could not process candidate #%s: %s', processing[processed], error)
+                        failedcandidates += 1
+                    else:
+                        if failures:
+                            logger.error('%d downloads failed for candidate #%s', failures, processing[processed])
+                            failedcandidates += 1
+                    processedcandidates += 1
+                    logger.info("-------------------------------------------")
+                    logger.info('%d out of %d candidates processed', processedcandidates, candidatetotal)
+                    logger.info("-------------------------------------------")
+            except KeyboardInterrupt:
+                # Skip the candidates and files still waiting, the executors
+                # return once the downloads already running are finished
+                logger.info('Interrupted, waiting for the running downloads to finish')
+                stop_event.set()
+        
+        if stop_event.is_set():
+            return 130
+        
+        if failedcandidates:
+            logger.error('%d out of %d candidates were not completely downloaded', failedcandidates, candidatetotal)
+            return 1
+        return 0
+    finally:
+        # Closing the database checkpoints its journal into the database file
+        if etag_database is not None:
+            commit_etags()
+            etag_database.close()
+            etag_database = None
+        log_listener.stop()
+        logger.removeHandler(log_handler)
+
 
+if __name__ == '__main__':
+    sys.exit(main())
 
 # In[ ]:
 